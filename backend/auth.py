@@ -1,50 +1,93 @@
-from datetime import datetime, timedelta
+from datetime import timedelta
 from typing import Optional
-from jose import JWTError, jwt
+import jwt
+from jwt import PyJWTError as JWTError
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import hmac
 import os
 import secrets
-import random
+import logging
+import time
 
-from database import get_user_by_id, get_user_by_phone, get_user_by_email
+from database import get_user_by_id, get_user_by_phone, get_user_by_email, update_user
 from utils import utc_now
 
+logger = logging.getLogger(__name__)
+
 # Security
 SECRET_KEY = os.environ.get('SECRET_KEY')
 if not SECRET_KEY:
     # Generate a persistent key for development only
-    import logging
-    logger = logging.getLogger(__name__)
     SECRET_KEY = secrets.token_urlsafe(32)
     logger.warning("SECRET_KEY not set in environment. Using temporary key. This will invalidate tokens on restart!")
     logger.warning("For production, set SECRET_KEY environment variable.")
 
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 30  # 30 days
+_ACCESS_TOKEN_TTL = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
 
 # Development mode flag for OTP exposure
 DEV_MODE = os.environ.get('DEV_MODE', 'true').lower() == 'true'
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Argon2id for new hashes; existing bcrypt hashes still verify and are
+# transparently upgraded on the next successful login.
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    default="argon2",
+    deprecated="auto",
+    argon2__type="ID",
+    argon2__time_cost=2,
+    argon2__memory_cost=65536,
+    argon2__parallelism=1,
+)
+# The configured default handler, called directly on the hot path to skip
+# CryptContext's per-call scheme dispatch. pwd_context stays for migration.
+_default_hasher = pwd_context.handler()
 security = HTTPBearer()
 
+# Password hashing is CPU-bound and releases the GIL, so run it off the event loop
+_hash_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix="pwhash")
+
+# Verified against on unknown accounts so both paths cost one hash
+_DUMMY_HASH = _default_hasher.hash("dummy-password-for-timing")
+
+# Resolve the legacy bcrypt backend at import too (passlib loads it lazily),
+# so the first login against an old hash doesn't pay for backend detection.
+# Together with the dummy hash above this moves ~100ms onto worker startup.
+try:
+    pwd_context.handler("bcrypt").get_backend()
+except Exception as e:
+    logger.warning(f"bcrypt backend unavailable, legacy hashes will not verify: {e}")
+
+# Verified tokens, so repeat requests skip the HMAC check: {token: (user_id, exp)}.
+# The user itself always comes from get_user_by_id, whose cache update_user clears.
+TOKEN_CACHE_TTL_SECONDS = 60
+_token_cache: TTLCache = TTLCache(maxsize=10_000, ttl=TOKEN_CACHE_TTL_SECONDS)
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
+    if _default_hasher.identify(hashed_password):
+        return _default_hasher.verify(plain_password, hashed_password)
     return pwd_context.verify(plain_password, hashed_password)
 
 def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+    return _default_hasher.hash(password)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_hash_pool, verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password: str) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_hash_pool, get_password_hash, password)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
-    to_encode = data.copy()
-    if expires_delta:
-        expire = utc_now() + expires_delta
-    else:
-        expire = utc_now() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
+    expire = utc_now() + (expires_delta or _ACCESS_TOKEN_TTL)
+    return jwt.encode({**data, "exp": expire}, SECRET_KEY, algorithm=ALGORITHM)
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     credentials_exception = HTTPException(
@@ -52,14 +95,22 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
+    token = credentials.credentials
+    cached = _token_cache.get(token)
+    if cached is not None and cached[1] > time.time():
+        user_id = cached[0]
+    else:
+        try:
+            payload = jwt.decode(
+                token, SECRET_KEY, algorithms=[ALGORITHM],
+                options={"require": ["exp", "sub"]}
+            )
+            user_id: str = payload.get("sub")
+            if user_id is None:
+                raise credentials_exception
+        except JWTError:
             raise credentials_exception
-    except JWTError:
-        raise credentials_exception
+        _token_cache[token] = (user_id, payload["exp"])
     
     user = await get_user_by_id(user_id)
     if user is None:
@@ -67,8 +118,12 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     return user
 
 def generate_otp() -> str:
-    """Generate a 6-digit OTP"""
-    return str(random.randint(100000, 999999))
+    """Generate a 6-digit OTP from a CSPRNG (leading zeros allowed)"""
+    return f"{secrets.randbelow(1_000_000):06d}"
+
+def verify_otp_code(stored_otp: str, submitted_otp: str) -> bool:
+    """Constant-time OTP comparison"""
+    return hmac.compare_digest(stored_otp.encode(), submitted_otp.encode())
 
 async def authenticate_user(phone_or_email: str, password: str):
     """Authenticate user with phone/email and password"""
@@ -78,10 +133,12 @@ async def authenticate_user(phone_or_email: str, password: str):
     else:
         user = await get_user_by_phone(phone_or_email)
     
-    if not user:
-        return False
-    if not user.get('hashed_password'):
+    if not user or not user.get('hashed_password'):
+        await verify_password_async(password, _DUMMY_HASH)
         return False
-    if not verify_password(password, user['hashed_password']):
+    if not await verify_password_async(password, user['hashed_password']):
         return False
+    if pwd_context.needs_update(user['hashed_password']):
+        user['hashed_password'] = await get_password_hash_async(password)
+        await update_user(user['id'], {'hashed_password': user['hashed_password']})
     return user
@@ -1,7 +1,11 @@
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import IndexModel
+from cachetools import TTLCache
 from typing import Optional
+import asyncio
+from datetime import datetime
 import os
-from datetime import datetime, timedelta
+import re
 import logging
 from utils import utc_now
 
@@ -15,7 +19,14 @@ class Database:
     def get_db(cls):
         if cls.db is None:
             mongo_url = os.environ['MONGO_URL']
-            cls.client = AsyncIOMotorClient(mongo_url)
+            # minPoolSize keeps connections warm so first requests skip the handshake
+            cls.client = AsyncIOMotorClient(
+                mongo_url,
+                maxPoolSize=int(os.environ.get('MONGO_MAX_POOL_SIZE', 100)),
+                minPoolSize=int(os.environ.get('MONGO_MIN_POOL_SIZE', 20)),
+                waitQueueTimeoutMS=int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 2000)),
+                serverSelectionTimeoutMS=int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000))
+            )
             cls.db = cls.client[os.environ.get('DB_NAME', 'chatapp')]
             logger.info("Database connection established")
         return cls.db
@@ -31,46 +42,102 @@ class Database:
         """Create database indexes for better performance"""
         db = cls.get_db()
         
-        # Drop existing indexes to recreate them properly
-        try:
-            await db.users.drop_index("phone_number_1")
-        except:
-            pass
-        try:
-            await db.users.drop_index("email_1")
-        except:
-            pass
+        # Drop legacy non-partial unique indexes once so they can be recreated
+        existing = await db.users.index_information()
+        for name in ("phone_number_1", "email_1"):
+            if name in existing and "partialFilterExpression" not in existing[name]:
+                await db.users.drop_index(name)
+        # Superseded by the *_lower search indexes
+        for name in ("user_search_text", "username_ci", "display_name_ci"):
+            if name in existing:
+                await db.users.drop_index(name)
         
         # Users indexes - partialFilterExpression ensures unique only when field exists
-        await db.users.create_index(
-            "phone_number", 
-            unique=True, 
-            partialFilterExpression={"phone_number": {"$type": "string"}}
-        )
-        await db.users.create_index(
-            "email", 
-            unique=True,
-            partialFilterExpression={"email": {"$type": "string"}}
-        )
-        await db.users.create_index("username", unique=True)
-        await db.users.create_index("google_id", sparse=True)
+        await db.users.create_indexes([
+            IndexModel(
+                "phone_number",
+                unique=True,
+                partialFilterExpression={"phone_number": {"$type": "string"}}
+            ),
+            IndexModel(
+                "email",
+                unique=True,
+                partialFilterExpression={"email": {"$type": "string"}}
+            ),
+            IndexModel("username", unique=True),
+            # get_user_by_id runs on every authenticated request (JWT "sub")
+            IndexModel("id", unique=True),
+            IndexModel("google_id", sparse=True),
+            # search_user_profiles: anchored prefix regex on lowercased copies
+            IndexModel("username_lower"),
+            IndexModel("display_name_lower"),
+        ])
         
-        # Messages indexes
-        await db.messages.create_index("chat_id")
-        await db.messages.create_index("sender_id")
-        await db.messages.create_index([("chat_id", 1), ("created_at", -1)])
-        await db.messages.create_index("scheduled_at", sparse=True)
+        # Messages indexes - (chat_id, created_at) is a prefix of the keyset index below
+        message_indexes = await db.messages.index_information()
+        if "chat_id_1_created_at_-1" in message_indexes:
+            await db.messages.drop_index("chat_id_1_created_at_-1")
+        await db.messages.create_indexes([
+            IndexModel("id", unique=True),
+            IndexModel("chat_id"),
+            IndexModel("sender_id"),
+            # Message paging: keyset on (created_at, id) within a chat
+            IndexModel([("chat_id", 1), ("created_at", -1), ("id", -1)]),
+            # get_unread_counts: equality on chat_id/deleted, then sender/read_by
+            IndexModel([("chat_id", 1), ("deleted", 1), ("sender_id", 1), ("read_by", 1)]),
+            IndexModel("scheduled_at", sparse=True),
+        ])
         
         # Chats indexes
-        await db.chats.create_index("participants")
-        await db.chats.create_index("created_by")
+        await db.chats.create_indexes([
+            IndexModel("id", unique=True),
+            IndexModel("participants"),
+            IndexModel("created_by"),
+            # One direct chat per user pair (see direct_chat_key)
+            IndexModel(
+                "participants_key",
+                unique=True,
+                partialFilterExpression={"participants_key": {"$type": "string"}}
+            ),
+        ])
         
-        # OTP indexes
-        await db.otps.create_index("phone_number")
-        await db.otps.create_index("created_at", expireAfterSeconds=600)  # Auto-delete after 10 minutes
+        # User relationship indexes
+        await db.user_relationships.create_indexes([
+            IndexModel([("user_id", 1), ("type", 1), ("target_id", 1)], unique=True),
+        ])
+        
+        # OTP indexes - expire each code at its own expires_at
+        otp_indexes = await db.otps.index_information()
+        if "created_at_1" in otp_indexes:
+            await db.otps.drop_index("created_at_1")
+        await db.otps.create_indexes([
+            IndexModel([("phone_number", 1), ("verified", 1)]),
+            IndexModel("expires_at", expireAfterSeconds=0),
+        ])
         
         logger.info("Database indexes created successfully")
 
+# Lowercased copies of user fields, kept for case-insensitive prefix search
+SEARCH_FIELDS = {"username": "username_lower", "display_name": "display_name_lower"}
+
+def with_search_fields(user_data: dict) -> dict:
+    """Set the lowercased search copies of any searchable fields in user_data"""
+    for field, lower_field in SEARCH_FIELDS.items():
+        if isinstance(user_data.get(field), str):
+            user_data[lower_field] = user_data[field].lower()
+    return user_data
+
+# Public profile fields; id-based lookups never load hashes or other private data
+USER_PROJECTION = {
+    '_id': 0, 'id': 1, 'username': 1, 'display_name': 1, 'avatar': 1, 'bio': 1,
+    'phone_number': 1, 'email': 1, 'role': 1, 'is_online': 1, 'last_seen': 1,
+    'created_at': 1
+}
+
+# Per-process cache of user documents by id, invalidated by update_user
+USER_DOC_CACHE_TTL_SECONDS = 60
+_user_doc_cache: TTLCache = TTLCache(maxsize=10_000, ttl=USER_DOC_CACHE_TTL_SECONDS)
+
 # Helper functions
 async def get_user_by_phone(phone_number: str):
     db = Database.get_db()
@@ -83,9 +150,48 @@ async def get_user_by_email(email: str):
     return user
 
 async def get_user_by_id(user_id: str):
+    user = _user_doc_cache.get(user_id)
+    if user is None:
+        db = Database.get_db()
+        user = await db.users.find_one({"id": user_id}, USER_PROJECTION)
+        if user is None:
+            return None
+        _user_doc_cache[user_id] = user
+    return dict(user)
+
+async def get_users_map(user_ids) -> dict:
+    """Fetch several users in one query: {user_id: user} (treat as read-only)"""
+    users_map = {}
+    missing = []
+    for user_id in set(user_ids):
+        user = _user_doc_cache.get(user_id)
+        if user is None:
+            missing.append(user_id)
+        else:
+            users_map[user_id] = user
+    if missing:
+        db = Database.get_db()
+        async for user in db.users.find({"id": {"$in": missing}}, USER_PROJECTION):
+            _user_doc_cache[user['id']] = user
+            users_map[user['id']] = user
+    return users_map
+
+async def search_user_profiles(query: str, exclude_user_id: str, limit: int = 20):
+    """Search-as-you-type: username/display_name or phone number prefix"""
     db = Database.get_db()
-    user = await db.users.find_one({"id": user_id})
-    return user
+    # Case-sensitive anchored regexes on indexed fields are bounded index range scans
+    prefix = {"$regex": f"^{re.escape(query.lower())}"}
+    clauses = [{lower_field: prefix} for lower_field in SEARCH_FIELDS.values()]
+    # Phone numbers are digits only, so other queries can't match one
+    if any(c.isdigit() for c in query):
+        # $type lets the partial phone_number index serve the regex
+        clauses.append({"phone_number": {"$type": "string", "$regex": f"^{re.escape(query)}"}})
+    
+    users = await db.users.find(
+        {"$or": clauses, "id": {"$ne": exclude_user_id}},
+        USER_PROJECTION
+    ).limit(limit).to_list(limit)
+    return users
 
 async def get_user_by_username(username: str):
     db = Database.get_db()
@@ -94,53 +200,163 @@ async def get_user_by_username(username: str):
 
 async def create_user(user_data: dict):
     db = Database.get_db()
-    result = await db.users.insert_one(user_data)
+    result = await db.users.insert_one(with_search_fields(user_data))
     return result.inserted_id
 
 async def update_user(user_id: str, update_data: dict):
     db = Database.get_db()
     update_data['updated_at'] = utc_now()
-    await db.users.update_one({"id": user_id}, {"$set": update_data})
+    await db.users.update_one({"id": user_id}, {"$set": with_search_fields(update_data)})
+    _user_doc_cache.pop(user_id, None)
+
+# Relationship types stored in the user_relationships collection
+RELATIONSHIP_CONTACT = "contact"
+RELATIONSHIP_BLOCKED = "blocked"
+
+async def add_relationship(user_id: str, target_id: str, rel_type: str):
+    db = Database.get_db()
+    await db.user_relationships.update_one(
+        {"user_id": user_id, "target_id": target_id, "type": rel_type},
+        {"$setOnInsert": {"created_at": utc_now()}},
+        upsert=True
+    )
+
+async def remove_relationship(user_id: str, target_id: str, rel_type: str):
+    db = Database.get_db()
+    await db.user_relationships.delete_one(
+        {"user_id": user_id, "target_id": target_id, "type": rel_type}
+    )
+
+async def get_relationship_ids(user_id: str, rel_type: str, limit: int = 1000, skip: int = 0):
+    db = Database.get_db()
+    docs = await db.user_relationships.find(
+        {"user_id": user_id, "type": rel_type},
+        {"_id": 0, "target_id": 1}
+    ).sort("created_at", 1).skip(skip).limit(limit).to_list(limit)
+    return [doc["target_id"] for doc in docs]
 
 async def get_chat_by_id(chat_id: str):
     db = Database.get_db()
     chat = await db.chats.find_one({"id": chat_id})
     return chat
 
+def direct_chat_key(participants) -> str:
+    """Order-independent key identifying a direct chat's user pair"""
+    return ":".join(sorted(participants))
+
+async def get_direct_chat(participants_key: str):
+    db = Database.get_db()
+    chat = await db.chats.find_one({"participants_key": participants_key}, {"_id": 0})
+    return chat
+
+async def get_chat_membership(chat_id: str, user_id: str) -> Optional[bool]:
+    """None if the chat doesn't exist, else whether user_id is a participant"""
+    db = Database.get_db()
+    chat = await db.chats.find_one(
+        {"id": chat_id},
+        {"_id": 0, "participants": {"$elemMatch": {"$eq": user_id}}}
+    )
+    if chat is None:
+        return None
+    return bool(chat.get("participants"))
+
+async def get_chat_with_participants(chat_id: str):
+    """Fetch a chat with participant profiles joined server-side as participant_details"""
+    db = Database.get_db()
+    pipeline = [
+        {"$match": {"id": chat_id}},
+        {"$limit": 1},
+        {"$lookup": {
+            "from": "users",
+            "localField": "participants",
+            "foreignField": "id",
+            "pipeline": [{"$project": USER_PROJECTION}],
+            "as": "participant_details"
+        }}
+    ]
+    chats = await db.chats.aggregate(pipeline).to_list(1)
+    return chats[0] if chats else None
+
 async def get_user_chats(user_id: str):
     db = Database.get_db()
     chats = await db.chats.find({"participants": user_id}).sort("updated_at", -1).to_list(1000)
     return chats
 
+async def get_unread_counts(chat_ids: list, user_id: str) -> dict:
+    """Unread message counts for several chats in one aggregation: {chat_id: n}"""
+    db = Database.get_db()
+    pipeline = [
+        {"$match": {
+            "chat_id": {"$in": chat_ids},
+            "sender_id": {"$ne": user_id},
+            "read_by": {"$ne": user_id},
+            "deleted": False
+        }},
+        {"$group": {"_id": "$chat_id", "count": {"$sum": 1}}}
+    ]
+    return {doc["_id"]: doc["count"] async for doc in db.messages.aggregate(pipeline)}
+
 async def create_chat(chat_data: dict):
     db = Database.get_db()
     result = await db.chats.insert_one(chat_data)
     return result.inserted_id
 
-async def get_chat_messages(chat_id: str, limit: int = 50, skip: int = 0):
+async def iter_chat_messages(
+    chat_id: str,
+    limit: int = 50,
+    before: Optional[datetime] = None,
+    before_id: Optional[str] = None
+):
+    """Yield the latest messages before the (before, before_id) cursor (keyset
+    paging on created_at, id) in chronological order, with the sender's profile
+    joined as `sender`"""
     db = Database.get_db()
-    messages = await db.messages.find(
-        {"chat_id": chat_id, "deleted": False}
-    ).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
-    return list(reversed(messages))  # Return in chronological order
+    # id breaks ties between messages stored in the same millisecond
+    query = {"chat_id": chat_id, "deleted": False}
+    if before is not None and before_id is not None:
+        query["$or"] = [
+            {"created_at": {"$lt": before}},
+            {"created_at": before, "id": {"$lt": before_id}}
+        ]
+    elif before is not None:
+        query["created_at"] = {"$lt": before}
+    pipeline = [
+        {"$match": query},
+        {"$sort": {"created_at": -1, "id": -1}},
+        {"$limit": limit},
+        {"$sort": {"created_at": 1, "id": 1}},  # Return in chronological order
+        {"$project": {"_id": 0}},
+        {"$lookup": {
+            "from": "users",
+            "localField": "sender_id",
+            "foreignField": "id",
+            "pipeline": [{"$project": USER_PROJECTION}],
+            "as": "sender"
+        }},
+        {"$unwind": {"path": "$sender", "preserveNullAndEmptyArrays": True}}
+    ]
+    async for message in db.messages.aggregate(pipeline):
+        yield message
 
 async def create_message(message_data: dict):
     db = Database.get_db()
-    result = await db.messages.insert_one(message_data)
-    # Update chat's last_message
-    await db.chats.update_one(
-        {"id": message_data["chat_id"]},
-        {
-            "$set": {
-                "last_message": {
-                    "content": message_data.get("content", ""),
-                    "created_at": message_data["created_at"],
-                    "sender_id": message_data["sender_id"],
-                    "message_type": message_data["message_type"]
-                },
-                "updated_at": utc_now()
+    # Insert the message and update the chat's last_message concurrently
+    result, _ = await asyncio.gather(
+        db.messages.insert_one(message_data),
+        db.chats.update_one(
+            {"id": message_data["chat_id"]},
+            {
+                "$set": {
+                    "last_message": {
+                        "content": message_data.get("content", ""),
+                        "created_at": message_data["created_at"],
+                        "sender_id": message_data["sender_id"],
+                        "message_type": message_data["message_type"]
+                    },
+                    "updated_at": message_data["created_at"]
+                }
             }
-        }
+        )
     )
     return result.inserted_id
 
@@ -149,7 +365,81 @@ async def update_message(message_id: str, update_data: dict):
     update_data['updated_at'] = utc_now()
     await db.messages.update_one({"id": message_id}, {"$set": update_data})
 
+async def update_own_message(message_id: str, sender_id: str, update_data: dict) -> Optional[str]:
+    """Update a message only if sender_id wrote it; returns the chat_id, or None"""
+    db = Database.get_db()
+    update_data['updated_at'] = utc_now()
+    message = await db.messages.find_one_and_update(
+        {"id": message_id, "sender_id": sender_id},
+        {"$set": update_data},
+        projection={"_id": 0, "chat_id": 1}
+    )
+    return message["chat_id"] if message else None
+
 async def get_message_by_id(message_id: str):
     db = Database.get_db()
     message = await db.messages.find_one({"id": message_id})
     return message
+
+async def mark_messages_read(message_ids: list, user_id: str) -> dict:
+    """Add read receipts for several messages at once: {chat_id: [newly read ids]}"""
+    db = Database.get_db()
+    query = {"id": {"$in": message_ids}, "read_by": {"$ne": user_id}}
+    unread = await db.messages.find(
+        query, {"_id": 0, "id": 1, "chat_id": 1}
+    ).to_list(len(message_ids))
+    if not unread:
+        return {}
+    await db.messages.update_many(
+        {"id": {"$in": [m["id"] for m in unread]}, "read_by": {"$ne": user_id}},
+        {
+            "$addToSet": {"read_by": user_id},
+            "$set": {"status": "read", "updated_at": utc_now()}
+        }
+    )
+    by_chat = {}
+    for m in unread:
+        by_chat.setdefault(m["chat_id"], []).append(m["id"])
+    return by_chat
+
+async def add_message_reaction(message_id: str, emoji: str, user_id: str) -> Optional[str]:
+    """Atomically add a reaction; returns the chat_id, or None if the message is missing"""
+    db = Database.get_db()
+    message = await db.messages.find_one_and_update(
+        {"id": message_id},
+        {
+            "$addToSet": {f"reactions.{emoji}": user_id},
+            "$set": {"updated_at": utc_now()}
+        },
+        projection={"_id": 0, "chat_id": 1}
+    )
+    return message["chat_id"] if message else None
+
+async def remove_message_reaction(message_id: str, emoji: str, user_id: str) -> Optional[str]:
+    """Atomically remove a reaction, dropping emojis left with no users"""
+    db = Database.get_db()
+    message = await db.messages.find_one_and_update(
+        {"id": message_id},
+        [{
+            "$set": {
+                "reactions": {"$arrayToObject": {"$filter": {
+                    "input": {"$map": {
+                        "input": {"$objectToArray": {"$ifNull": ["$reactions", {}]}},
+                        "as": "r",
+                        "in": {
+                            "k": "$$r.k",
+                            "v": {"$cond": [
+                                {"$eq": ["$$r.k", {"$literal": emoji}]},
+                                {"$setDifference": ["$$r.v", {"$literal": [user_id]}]},
+                                "$$r.v"
+                            ]}
+                        }
+                    }},
+                    "cond": {"$gt": [{"$size": "$$this.v"}, 0]}
+                }}},
+                "updated_at": utc_now()
+            }
+        }],
+        projection={"_id": 0, "chat_id": 1}
+    )
+    return message["chat_id"] if message else None
@@ -0,0 +1,51 @@
+"""
+One-off migration: set participants_key on existing direct chats so the
+direct-chat duplicate check (and its unique index) covers them.
+
+Usage: python migrate_direct_chats.py
+"""
+import asyncio
+import logging
+from pathlib import Path
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+from database import Database, direct_chat_key
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+async def migrate():
+    db = Database.get_db()
+    await Database.create_indexes()
+
+    query = {'chat_type': 'direct', 'participants_key': {'$exists': False}}
+    projection = {'_id': 0, 'id': 1, 'participants': 1}
+    seen = set()
+    ops = []
+    duplicates = 0
+
+    # Oldest chat of each pair keeps the key; later duplicates are left unkeyed
+    async for chat in db.chats.find(query, projection).sort('created_at', 1):
+        key = direct_chat_key(chat['participants'])
+        if key in seen or await db.chats.count_documents({'participants_key': key}, limit=1):
+            duplicates += 1
+            logger.warning(f"Duplicate direct chat {chat['id']} for {key}, left without key")
+            continue
+        seen.add(key)
+        ops.append(UpdateOne({'id': chat['id']}, {'$set': {'participants_key': key}}))
+
+    if ops:
+        await db.chats.bulk_write(ops, ordered=False)
+
+    logger.info(f"Keyed {len(ops)} direct chats ({duplicates} duplicates skipped)")
+    await Database.close_db()
+
+if __name__ == '__main__':
+    asyncio.run(migrate())
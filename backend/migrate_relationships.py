@@ -0,0 +1,61 @@
+"""
+One-off migration: move embedded User.contacts / User.blocked_users arrays
+into the user_relationships collection.
+
+Usage: python migrate_relationships.py
+"""
+import asyncio
+import logging
+from pathlib import Path
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+from database import Database, RELATIONSHIP_CONTACT, RELATIONSHIP_BLOCKED
+from utils import utc_now
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+EMBEDDED_FIELDS = {
+    'contacts': RELATIONSHIP_CONTACT,
+    'blocked_users': RELATIONSHIP_BLOCKED,
+}
+
+async def migrate():
+    db = Database.get_db()
+    await Database.create_indexes()
+
+    query = {'$or': [{field: {'$exists': True}} for field in EMBEDDED_FIELDS]}
+    projection = {'_id': 0, 'id': 1, **{field: 1 for field in EMBEDDED_FIELDS}}
+    migrated = 0
+
+    async for user in db.users.find(query, projection):
+        now = utc_now()
+        ops = [
+            UpdateOne(
+                {'user_id': user['id'], 'target_id': target_id, 'type': rel_type},
+                {'$setOnInsert': {'created_at': now}},
+                upsert=True
+            )
+            for field, rel_type in EMBEDDED_FIELDS.items()
+            for target_id in user.get(field) or []
+        ]
+        if ops:
+            await db.user_relationships.bulk_write(ops, ordered=False)
+        await db.users.update_one(
+            {'id': user['id']},
+            {'$unset': {field: '' for field in EMBEDDED_FIELDS}}
+        )
+        migrated += 1
+
+    logger.info(f"Migrated relationships for {migrated} users")
+    await Database.close_db()
+
+if __name__ == '__main__':
+    asyncio.run(migrate())
@@ -0,0 +1,45 @@
+"""
+One-off migration: set the lowercased username/display_name copies on existing
+users so search_user_profiles (and its indexes) covers them.
+
+Usage: python migrate_user_search_fields.py
+"""
+import asyncio
+import logging
+from pathlib import Path
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+from database import Database, SEARCH_FIELDS, with_search_fields
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+async def migrate():
+    db = Database.get_db()
+    await Database.create_indexes()
+
+    query = {'$or': [{lower_field: {'$exists': False}} for lower_field in SEARCH_FIELDS.values()]}
+    projection = {'_id': 0, 'id': 1, **{field: 1 for field in SEARCH_FIELDS}}
+    ops = []
+
+    async for user in db.users.find(query, projection):
+        fields = with_search_fields({field: user.get(field) for field in SEARCH_FIELDS})
+        search_fields = {k: v for k, v in fields.items() if k in SEARCH_FIELDS.values()}
+        if search_fields:
+            ops.append(UpdateOne({'id': user['id']}, {'$set': search_fields}))
+
+    if ops:
+        await db.users.bulk_write(ops, ordered=False)
+
+    logger.info(f"Set search fields on {len(ops)} users")
+    await Database.close_db()
+
+if __name__ == '__main__':
+    asyncio.run(migrate())
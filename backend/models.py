@@ -1,4 +1,4 @@
-from pydantic import BaseModel, Field, EmailStr
+from pydantic import BaseModel, Field, EmailStr, SecretStr
 from typing import Optional, List, Dict, Any
 from datetime import datetime
 from enum import Enum
@@ -37,7 +37,7 @@ class UserBase(BaseModel):
     role: UserRole = UserRole.REGULAR
 
 class UserCreate(UserBase):
-    password: Optional[str] = None
+    password: Optional[SecretStr] = None
 
 class UserLogin(BaseModel):
     phone_number: Optional[str] = None
@@ -50,13 +50,30 @@ class UserResponse(UserBase):
     last_seen: Optional[datetime] = None
     created_at: datetime
 
+    @classmethod
+    def from_user(cls, user: Dict[str, Any], **overrides) -> "UserResponse":
+        """Build from a stored user document, skipping re-validation"""
+        data = {
+            'id': user['id'],
+            'phone_number': user.get('phone_number'),
+            'email': user.get('email'),
+            'username': user['username'],
+            'display_name': user['display_name'],
+            'bio': user.get('bio'),
+            'avatar': user.get('avatar'),
+            'role': UserRole(user.get('role', UserRole.REGULAR)),
+            'is_online': user.get('is_online', False),
+            'last_seen': user.get('last_seen'),
+            'created_at': user['created_at'],
+        }
+        data.update(overrides)
+        return cls.model_construct(**data)
+
 class User(UserBase):
     id: str
     hashed_password: Optional[str] = None
     is_online: bool = False
     last_seen: Optional[datetime] = None
-    contacts: List[str] = []  # user IDs
-    blocked_users: List[str] = []
     created_at: datetime = Field(default_factory=utc_now)
     updated_at: datetime = Field(default_factory=utc_now)
     google_id: Optional[str] = None
@@ -108,14 +125,26 @@ class Message(MessageBase):
 class MessageResponse(Message):
     sender: Optional[UserResponse] = None
 
+    @classmethod
+    def from_message(cls, message: Dict[str, Any], **overrides) -> "MessageResponse":
+        """Build from a stored message document, skipping re-validation"""
+        data = {name: message[name] for name in cls.model_fields if name in message}
+        data['message_type'] = MessageType(data.get('message_type', MessageType.TEXT))
+        data['status'] = MessageStatus(data.get('status', MessageStatus.SENT))
+        data.update(overrides)
+        return cls.model_construct(**data)
+
 # Reaction Models
+# Emoji is used as a key under Message.reactions, so it must be a valid Mongo field name
+EMOJI_KEY_PATTERN = r"^[^$.][^.]*$"
+
 class ReactionCreate(BaseModel):
     message_id: str
-    emoji: str
+    emoji: str = Field(..., max_length=32, pattern=EMOJI_KEY_PATTERN)
 
 class ReactionRemove(BaseModel):
     message_id: str
-    emoji: str
+    emoji: str = Field(..., max_length=32, pattern=EMOJI_KEY_PATTERN)
 
 # Chat Models
 class ChatBase(BaseModel):
@@ -142,6 +171,14 @@ class ChatResponse(Chat):
     participant_details: Optional[List[UserResponse]] = None
     unread_count: Optional[int] = 0
 
+    @classmethod
+    def from_chat(cls, chat: Dict[str, Any], **overrides) -> "ChatResponse":
+        """Build from a stored chat document, skipping re-validation"""
+        data = {name: chat[name] for name in cls.model_fields if name in chat}
+        data['chat_type'] = ChatType(data['chat_type'])
+        data.update(overrides)
+        return cls.model_construct(**data)
+
 # Typing Indicator
 class TypingIndicator(BaseModel):
     chat_id: str
@@ -1,6 +1,7 @@
 from fastapi import APIRouter, HTTPException, status, Depends, Request
-from datetime import datetime, timedelta
+from datetime import timedelta
 import uuid
+import asyncio
 import logging
 
 from models import (
@@ -8,8 +9,9 @@ from models import (
     OTPRequest, OTPVerify, User
 )
 from auth import (
-    get_password_hash, create_access_token, authenticate_user,
-    generate_otp, get_current_user
+    get_password_hash_async, create_access_token, authenticate_user,
+    generate_otp, verify_otp_code, get_current_user,
+    DEV_MODE
 )
 from database import (
     Database, get_user_by_phone, get_user_by_email,
@@ -20,54 +22,59 @@ from utils import utc_now
 router = APIRouter(prefix="/auth", tags=["Authentication"])
 logger = logging.getLogger(__name__)
 
+OTP_TTL = timedelta(minutes=10)
+
 # Import limiter from server (will be set at runtime)
 from server import limiter
 
+async def _no_match():
+    return None
+
 @router.post("/register", response_model=Token)
-async def register(user_data: UserCreate):
+@limiter.limit("10/hour")
+async def register(request: Request, user_data: UserCreate):
     """Register a new user"""
-    db = Database.get_db()
+    # Check if user already exists (independent lookups, run concurrently)
+    existing_phone, existing_email, existing_username = await asyncio.gather(
+        get_user_by_phone(user_data.phone_number) if user_data.phone_number else _no_match(),
+        get_user_by_email(user_data.email) if user_data.email else _no_match(),
+        get_user_by_username(user_data.username)
+    )
+    
+    if existing_phone:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Phone number already registered"
+        )
     
-    # Check if user already exists
-    if user_data.phone_number:
-        existing = await get_user_by_phone(user_data.phone_number)
-        if existing:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Phone number already registered"
-            )
-    
-    if user_data.email:
-        existing = await get_user_by_email(user_data.email)
-        if existing:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Email already registered"
-            )
-    
-    existing = await get_user_by_username(user_data.username)
-    if existing:
+    if existing_email:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Email already registered"
+        )
+    
+    if existing_username:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Username already taken"
         )
     
     # Create user
-    user_id = str(uuid.uuid4())
-    user_dict = user_data.dict()
+    user_id = uuid.uuid4().hex
+    now = utc_now()
+    user_dict = user_data.model_dump(exclude={'password'})
     
     # Hash password if provided
-    if user_dict.get('password'):
-        user_dict['hashed_password'] = get_password_hash(user_dict['password'])
-        del user_dict['password']
+    if user_data.password and user_data.password.get_secret_value():
+        user_dict['hashed_password'] = await get_password_hash_async(
+            user_data.password.get_secret_value()
+        )
     
     user_dict.update({
         'id': user_id,
-        'created_at': utc_now(),
-        'updated_at': utc_now(),
-        'is_online': True,
-        'contacts': [],
-        'blocked_users': []
+        'created_at': now,
+        'updated_at': now,
+        'is_online': True
     })
     
     await create_user(user_dict)
@@ -75,18 +82,7 @@ async def register(user_data: UserCreate):
     # Create access token
     access_token = create_access_token(data={"sub": user_id})
     
-    user_response = UserResponse(
-        id=user_id,
-        phone_number=user_data.phone_number,
-        email=user_data.email,
-        username=user_data.username,
-        display_name=user_data.display_name,
-        bio=user_data.bio,
-        avatar=user_data.avatar,
-        role=user_data.role,
-        is_online=True,
-        created_at=utc_now()
-    )
+    user_response = UserResponse.from_user(user_dict)
     
     return Token(access_token=access_token, user=user_response)
 
@@ -121,19 +117,7 @@ async def login(request: Request, login_data: UserLogin):
     # Create access token
     access_token = create_access_token(data={"sub": user['id']})
     
-    user_response = UserResponse(
-        id=user['id'],
-        phone_number=user.get('phone_number'),
-        email=user.get('email'),
-        username=user['username'],
-        display_name=user['display_name'],
-        bio=user.get('bio'),
-        avatar=user.get('avatar'),
-        role=user.get('role', 'regular'),
-        is_online=True,
-        last_seen=user.get('last_seen'),
-        created_at=user['created_at']
-    )
+    user_response = UserResponse.from_user(user, is_online=True)
     
     return Token(access_token=access_token, user=user_response)
 
@@ -145,27 +129,28 @@ async def request_otp(request: Request, otp_request: OTPRequest):
     
     # Generate OTP
     otp_code = generate_otp()
+    now = utc_now()
     
     # Store OTP in database
     otp_data = {
         'phone_number': otp_request.phone_number,
         'otp': otp_code,
-        'created_at': utc_now(),
-        'expires_at': utc_now() + timedelta(minutes=10),
+        'created_at': now,
+        'expires_at': now + OTP_TTL,
         'verified': False
     }
     
-    # Delete old OTPs for this phone number
-    await db.otps.delete_many({'phone_number': otp_request.phone_number})
-    
-    # Insert new OTP
-    await db.otps.insert_one(otp_data)
+    # Replace any previous OTP for this phone number
+    await db.otps.replace_one(
+        {'phone_number': otp_request.phone_number},
+        otp_data,
+        upsert=True
+    )
     
     # In production, send OTP via SMS (Twilio, etc.)
     logger.info(f"OTP for {otp_request.phone_number}: {otp_code}")
     
     # Only expose OTP in development mode
-    from auth import DEV_MODE
     response = {"message": "OTP sent successfully"}
     if DEV_MODE:
         response["otp"] = otp_code
@@ -174,42 +159,40 @@ async def request_otp(request: Request, otp_request: OTPRequest):
     return response
 
 @router.post("/verify-otp", response_model=Token)
-async def verify_otp(otp_verify: OTPVerify):
+@limiter.limit("5/minute")
+async def verify_otp(request: Request, otp_verify: OTPVerify):
     """Verify OTP and create/login user"""
     db = Database.get_db()
     
-    # Find OTP
+    now = utc_now()
+    
+    # Find a live OTP (request_otp keeps at most one per phone number)
     otp_record = await db.otps.find_one({
         'phone_number': otp_verify.phone_number,
-        'otp': otp_verify.otp,
-        'verified': False
+        'verified': False,
+        'expires_at': {'$gt': now}
     })
     
-    if not otp_record:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Invalid OTP"
+    # Consume it atomically so concurrent requests can't both redeem the code
+    if (
+        not otp_record
+        or not verify_otp_code(otp_record['otp'], otp_verify.otp)
+        or not await db.otps.find_one_and_update(
+            {'_id': otp_record['_id'], 'verified': False},
+            {'$set': {'verified': True}}
         )
-    
-    # Check if OTP expired
-    if otp_record['expires_at'] < utc_now():
+    ):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="OTP expired"
+            detail="Invalid or expired OTP"
         )
     
-    # Mark OTP as verified
-    await db.otps.update_one(
-        {'_id': otp_record['_id']},
-        {'$set': {'verified': True}}
-    )
-    
     # Check if user exists
     user = await get_user_by_phone(otp_verify.phone_number)
     
     if not user:
         # Create new user
-        user_id = str(uuid.uuid4())
+        user_id = uuid.uuid4().hex
         username = f"user_{otp_verify.phone_number[-6:]}"  # Generate username from phone
         
         user_dict = {
@@ -217,54 +200,29 @@ async def verify_otp(otp_verify: OTPVerify):
             'phone_number': otp_verify.phone_number,
             'username': username,
             'display_name': username,
-            'created_at': utc_now(),
-            'updated_at': utc_now(),
+            'created_at': now,
+            'updated_at': now,
             'is_online': True,
-            'role': 'regular',
-            'contacts': [],
-            'blocked_users': []
+            'role': 'regular'
         }
         
         await create_user(user_dict)
         user = user_dict
     else:
         # Update existing user
-        await update_user(user['id'], {'is_online': True, 'last_seen': utc_now()})
+        await update_user(user['id'], {'is_online': True, 'last_seen': now})
     
     # Create access token
     access_token = create_access_token(data={"sub": user['id']})
     
-    user_response = UserResponse(
-        id=user['id'],
-        phone_number=user.get('phone_number'),
-        email=user.get('email'),
-        username=user['username'],
-        display_name=user['display_name'],
-        bio=user.get('bio'),
-        avatar=user.get('avatar'),
-        role=user.get('role', 'regular'),
-        is_online=True,
-        created_at=user['created_at']
-    )
+    user_response = UserResponse.from_user(user, is_online=True)
     
     return Token(access_token=access_token, user=user_response)
 
 @router.get("/me", response_model=UserResponse)
 async def get_me(current_user: dict = Depends(get_current_user)):
     """Get current user profile"""
-    return UserResponse(
-        id=current_user['id'],
-        phone_number=current_user.get('phone_number'),
-        email=current_user.get('email'),
-        username=current_user['username'],
-        display_name=current_user['display_name'],
-        bio=current_user.get('bio'),
-        avatar=current_user.get('avatar'),
-        role=current_user.get('role', 'regular'),
-        is_online=current_user.get('is_online', False),
-        last_seen=current_user.get('last_seen'),
-        created_at=current_user['created_at']
-    )
+    return UserResponse.from_user(current_user)
 
 @router.put("/profile", response_model=UserResponse)
 async def update_profile(
@@ -287,16 +245,4 @@ async def update_profile(
         await update_user(current_user['id'], update_data)
         current_user.update(update_data)
     
-    return UserResponse(
-        id=current_user['id'],
-        phone_number=current_user.get('phone_number'),
-        email=current_user.get('email'),
-        username=current_user['username'],
-        display_name=current_user['display_name'],
-        bio=current_user.get('bio'),
-        avatar=current_user.get('avatar'),
-        role=current_user.get('role', 'regular'),
-        is_online=current_user.get('is_online', False),
-        last_seen=current_user.get('last_seen'),
-        created_at=current_user['created_at']
-    )
+    return UserResponse.from_user(current_user)
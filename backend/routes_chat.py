@@ -1,8 +1,11 @@
-from fastapi import APIRouter, HTTPException, status, Depends, Query
+from fastapi import APIRouter, HTTPException, status, Depends, Query, BackgroundTasks
+from fastapi.responses import StreamingResponse
 from typing import List, Optional
 import uuid
+import asyncio
 from datetime import datetime
 import logging
+from pymongo.errors import DuplicateKeyError
 
 from models import (
     ChatCreate, ChatResponse, MessageCreate, MessageResponse,
@@ -10,16 +13,34 @@ from models import (
 )
 from auth import get_current_user
 from database import (
-    Database, get_chat_by_id, get_user_chats, create_chat,
-    get_chat_messages, create_message, get_message_by_id,
-    update_message, get_user_by_id
+    get_chat_membership, get_chat_with_participants, get_user_chats,
+    direct_chat_key, get_direct_chat,
+    create_chat, iter_chat_messages, create_message, get_message_by_id,
+    update_own_message, get_users_map,
+    add_message_reaction, remove_message_reaction, get_unread_counts
 )
 from socket_manager import socket_manager
-from utils import utc_now
+from utils import utc_now, json_dumps, APIJSONResponse
 
 router = APIRouter(prefix="/chats", tags=["Chats"])
 logger = logging.getLogger(__name__)
 
+async def _require_participant(chat_id: str, user_id: str):
+    """404 if the chat doesn't exist, 403 if user_id isn't in it"""
+    is_member = await get_chat_membership(chat_id, user_id)
+    
+    if is_member is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Chat not found"
+        )
+    
+    if not is_member:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not a participant of this chat"
+        )
+
 @router.post("/", response_model=ChatResponse)
 async def create_new_chat(
     chat_data: ChatCreate,
@@ -37,56 +58,52 @@ async def create_new_chat(
             detail="Direct chat must have exactly 2 participants"
         )
     
-    # Check if direct chat already exists
+    # Check if direct chat already exists, by its canonical participant pair
+    participants_key = None
     if chat_data.chat_type == ChatType.DIRECT:
-        db = Database.get_db()
-        existing_chat = await db.chats.find_one({
-            'chat_type': 'direct',
-            'participants': {'$all': chat_data.participants}
-        })
+        participants_key = direct_chat_key(chat_data.participants)
+        existing_chat = await get_direct_chat(participants_key)
         
         if existing_chat:
             # Return existing chat
-            return ChatResponse(**existing_chat)
+            return APIJSONResponse(ChatResponse.from_chat(existing_chat).model_dump())
     
     # Create new chat
-    chat_id = str(uuid.uuid4())
-    chat_dict = chat_data.dict()
+    chat_id = uuid.uuid4().hex
+    now = utc_now()
+    chat_dict = chat_data.model_dump()
     chat_dict.update({
         'id': chat_id,
         'created_by': current_user['id'],
         'admins': [current_user['id']],
-        'created_at': utc_now(),
-        'updated_at': utc_now(),
+        'created_at': now,
+        'updated_at': now,
         'pinned_messages': [],
         'muted_by': []
     })
-    
-    await create_chat(chat_dict)
-    
-    # Get participant details
+    if participants_key:
+        chat_dict['participants_key'] = participants_key
+    
+    # Insert the chat and fetch participant details (one $in query) concurrently
+    try:
+        _, users_map = await asyncio.gather(
+            create_chat(chat_dict),
+            get_users_map(chat_data.participants)
+        )
+    except DuplicateKeyError:
+        # A concurrent request created the same direct chat first
+        return APIJSONResponse(
+            ChatResponse.from_chat(await get_direct_chat(participants_key)).model_dump()
+        )
     participants_details = []
     for participant_id in chat_data.participants:
-        user = await get_user_by_id(participant_id)
+        user = users_map.get(participant_id)
         if user:
-            participants_details.append(UserResponse(
-                id=user['id'],
-                username=user['username'],
-                display_name=user['display_name'],
-                avatar=user.get('avatar'),
-                bio=user.get('bio'),
-                phone_number=user.get('phone_number'),
-                email=user.get('email'),
-                role=user.get('role', 'regular'),
-                is_online=user.get('is_online', False),
-                last_seen=user.get('last_seen'),
-                created_at=user['created_at']
-            ))
-    
-    response = ChatResponse(**chat_dict)
-    response.participant_details = participants_details
-    
-    return response
+            participants_details.append(UserResponse.from_user(user))
+    
+    response = ChatResponse.from_chat(chat_dict, participant_details=participants_details)
+    
+    return APIJSONResponse(response.model_dump())
 
 @router.get("/", response_model=List[ChatResponse])
 async def get_chats(current_user: dict = Depends(get_current_user)):
@@ -98,10 +115,11 @@ async def get_chats(current_user: dict = Depends(get_current_user)):
     for chat in chats:
         all_participant_ids.update(chat['participants'])
     
-    # Batch fetch all users
-    db = Database.get_db()
-    users_list = await db.users.find({"id": {"$in": list(all_participant_ids)}}).to_list(None)
-    users_map = {user['id']: user for user in users_list}
+    # Batch fetch all users and count unread messages for all chats, concurrently
+    users_map, unread_counts = await asyncio.gather(
+        get_users_map(all_participant_ids),
+        get_unread_counts([chat['id'] for chat in chats], current_user['id'])
+    )
     
     result = []
     for chat in chats:
@@ -110,35 +128,16 @@ async def get_chats(current_user: dict = Depends(get_current_user)):
         for participant_id in chat['participants']:
             user = users_map.get(participant_id)
             if user:
-                participants_details.append(UserResponse(
-                    id=user['id'],
-                    username=user['username'],
-                    display_name=user['display_name'],
-                    avatar=user.get('avatar'),
-                    bio=user.get('bio'),
-                    phone_number=user.get('phone_number'),
-                    email=user.get('email'),
-                    role=user.get('role', 'regular'),
-                    is_online=user.get('is_online', False),
-                    last_seen=user.get('last_seen'),
-                    created_at=user['created_at']
-                ))
+                participants_details.append(UserResponse.from_user(user))
         
-        # Count unread messages
-        db = Database.get_db()
-        unread_count = await db.messages.count_documents({
-            'chat_id': chat['id'],
-            'sender_id': {'$ne': current_user['id']},
-            'read_by': {'$ne': current_user['id']},
-            'deleted': False
-        })
-        
-        chat_response = ChatResponse(**chat)
-        chat_response.participant_details = participants_details
-        chat_response.unread_count = unread_count
-        result.append(chat_response)
-    
-    return result
+        result.append(ChatResponse.from_chat(
+            chat,
+            participant_details=participants_details,
+            unread_count=unread_counts.get(chat['id'], 0)
+        ).model_dump())
+    
+    # Built from stored documents: skip response_model re-validation
+    return APIJSONResponse(result)
 
 @router.get("/{chat_id}", response_model=ChatResponse)
 async def get_chat(
@@ -146,7 +145,7 @@ async def get_chat(
     current_user: dict = Depends(get_current_user)
 ):
     """Get chat by ID"""
-    chat = await get_chat_by_id(chat_id)
+    chat = await get_chat_with_participants(chat_id)
     
     if not chat:
         raise HTTPException(
@@ -160,110 +159,58 @@ async def get_chat(
             detail="Not a participant of this chat"
         )
     
-    # Get participant details
-    participants_details = []
-    for participant_id in chat['participants']:
-        user = await get_user_by_id(participant_id)
-        if user:
-            participants_details.append(UserResponse(
-                id=user['id'],
-                username=user['username'],
-                display_name=user['display_name'],
-                avatar=user.get('avatar'),
-                bio=user.get('bio'),
-                phone_number=user.get('phone_number'),
-                email=user.get('email'),
-                role=user.get('role', 'regular'),
-                is_online=user.get('is_online', False),
-                last_seen=user.get('last_seen'),
-                created_at=user['created_at']
-            ))
-    
-    chat_response = ChatResponse(**chat)
-    chat_response.participant_details = participants_details
-    
-    return chat_response
+    # Participant details come back from $lookup unordered; keep participant order
+    users_map = {user['id']: user for user in chat.pop('participant_details')}
+    participants_details = [
+        UserResponse.from_user(users_map[participant_id])
+        for participant_id in chat['participants']
+        if participant_id in users_map
+    ]
+    
+    response = ChatResponse.from_chat(chat, participant_details=participants_details)
+    
+    return APIJSONResponse(response.model_dump())
 
 @router.get("/{chat_id}/messages", response_model=List[MessageResponse])
 async def get_messages(
     chat_id: str,
-    limit: int = Query(default=50, le=100),
-    skip: int = Query(default=0, ge=0),
+    limit: int = Query(default=50, ge=1, le=100),
+    before: Optional[datetime] = Query(default=None),
+    before_id: Optional[str] = Query(default=None),
     current_user: dict = Depends(get_current_user)
 ):
-    """Get messages for a chat"""
-    chat = await get_chat_by_id(chat_id)
-    
-    if not chat:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Chat not found"
-        )
-    
-    if current_user['id'] not in chat['participants']:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Not a participant of this chat"
-        )
-    
-    messages = await get_chat_messages(chat_id, limit, skip)
-    
-    # Batch fetch all unique senders
-    sender_ids = list(set(msg['sender_id'] for msg in messages))
-    db = Database.get_db()
-    senders_list = await db.users.find({"id": {"$in": sender_ids}}).to_list(None)
-    senders_map = {user['id']: user for user in senders_list}
-    
-    # Add sender details to each message
-    result = []
-    for msg in messages:
-        sender = senders_map.get(msg['sender_id'])
-        sender_response = None
-        if sender:
-            sender_response = UserResponse(
-                id=sender['id'],
-                username=sender['username'],
-                display_name=sender['display_name'],
-                avatar=sender.get('avatar'),
-                bio=sender.get('bio'),
-                phone_number=sender.get('phone_number'),
-                email=sender.get('email'),
-                role=sender.get('role', 'regular'),
-                is_online=sender.get('is_online', False),
-                last_seen=sender.get('last_seen'),
-                created_at=sender['created_at']
-            )
-        
-        msg_response = MessageResponse(**msg)
-        msg_response.sender = sender_response
-        result.append(msg_response)
-    
-    return result
+    """Get messages for a chat, optionally only those before the (before, before_id) cursor"""
+    await _require_participant(chat_id, current_user['id'])
+    
+    # Stream the JSON array as the cursor yields, instead of building the page first
+    async def stream():
+        separator = b'['
+        senders = {}  # sender_id -> UserResponse, built once per page
+        async for msg in iter_chat_messages(chat_id, limit, before, before_id):
+            sender_id = msg['sender_id']
+            if sender_id not in senders:
+                senders[sender_id] = UserResponse.from_user(msg['sender']) if msg.get('sender') else None
+            response = MessageResponse.from_message(msg, sender=senders[sender_id])
+            yield separator + json_dumps(response.model_dump())
+            separator = b','
+        yield b'[]' if separator == b'[' else b']'
+    
+    return StreamingResponse(stream(), media_type="application/json")
 
 @router.post("/{chat_id}/messages", response_model=MessageResponse)
 async def send_message(
     chat_id: str,
     message_data: MessageCreate,
+    background_tasks: BackgroundTasks,
     current_user: dict = Depends(get_current_user)
 ):
     """Send a message to a chat"""
-    chat = await get_chat_by_id(chat_id)
-    
-    if not chat:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Chat not found"
-        )
-    
-    if current_user['id'] not in chat['participants']:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Not a participant of this chat"
-        )
+    await _require_participant(chat_id, current_user['id'])
     
     # Create message
-    message_id = str(uuid.uuid4())
-    message_dict = message_data.dict()
+    message_id = uuid.uuid4().hex
+    now = utc_now()
+    message_dict = message_data.model_dump()
     message_dict.update({
         'id': message_id,
         'sender_id': current_user['id'],
@@ -274,64 +221,55 @@ async def send_message(
         'reactions': {},
         'edited': False,
         'deleted': False,
-        'created_at': utc_now(),
-        'updated_at': utc_now()
+        'created_at': now,
+        'updated_at': now
     })
     
     await create_message(message_dict)
     
-    # Get sender details
-    sender = await get_user_by_id(current_user['id'])
-    sender_response = UserResponse(
-        id=sender['id'],
-        username=sender['username'],
-        display_name=sender['display_name'],
-        avatar=sender.get('avatar'),
-        bio=sender.get('bio'),
-        phone_number=sender.get('phone_number'),
-        email=sender.get('email'),
-        role=sender.get('role', 'regular'),
-        is_online=sender.get('is_online', False),
-        last_seen=sender.get('last_seen'),
-        created_at=sender['created_at']
-    )
+    # Sender details: current_user is already the projected user document
+    sender_response = UserResponse.from_user(current_user)
+    
+    response = MessageResponse.from_message(message_dict, sender=sender_response)
     
-    response = MessageResponse(**message_dict)
-    response.sender = sender_response
+    # Dump once for both the Socket.IO broadcast and the HTTP body
+    payload = response.model_dump()
     
-    # Broadcast message via Socket.IO
-    await socket_manager.send_message_to_chat(chat_id, response.dict())
+    # Broadcast message via Socket.IO after the response is sent
+    background_tasks.add_task(socket_manager.send_message_to_chat, chat_id, payload)
     
-    return response
+    return APIJSONResponse(payload)
+
+async def _raise_message_not_editable(message_id: str, action: str):
+    """Report why an ownership-guarded update matched nothing"""
+    if not await get_message_by_id(message_id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Message not found"
+        )
+    raise HTTPException(
+        status_code=status.HTTP_403_FORBIDDEN,
+        detail=f"Can only {action} your own messages"
+    )
 
 @router.put("/messages/{message_id}")
 async def edit_message(
     message_id: str,
     content: str,
+    background_tasks: BackgroundTasks,
     current_user: dict = Depends(get_current_user)
 ):
     """Edit a message"""
-    message = await get_message_by_id(message_id)
-    
-    if not message:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Message not found"
-        )
-    
-    if message['sender_id'] != current_user['id']:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Can only edit your own messages"
-        )
-    
-    await update_message(message_id, {
+    chat_id = await update_own_message(message_id, current_user['id'], {
         'content': content,
         'edited': True
     })
     
+    if not chat_id:
+        await _raise_message_not_editable(message_id, "edit")
+    
     # Broadcast update via Socket.IO
-    await socket_manager.send_message_to_chat(message['chat_id'], {
+    background_tasks.add_task(socket_manager.send_message_to_chat, chat_id, {
         'event': 'message_edited',
         'message_id': message_id,
         'content': content
@@ -342,33 +280,39 @@ async def edit_message(
 @router.delete("/messages/{message_id}")
 async def delete_message(
     message_id: str,
+    background_tasks: BackgroundTasks,
     for_everyone: bool = False,
     current_user: dict = Depends(get_current_user)
 ):
     """Delete a message"""
-    message = await get_message_by_id(message_id)
+    if not for_everyone:
+        message = await get_message_by_id(message_id)
+        if not message:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Message not found"
+            )
+        if message['sender_id'] != current_user['id']:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Can only delete your own messages"
+            )
+        return {"message": "Message deleted"}
     
-    if not message:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Message not found"
-        )
+    # Delete for everyone
+    chat_id = await update_own_message(message_id, current_user['id'], {
+        'deleted': True,
+        'content': 'This message was deleted'
+    })
     
-    if message['sender_id'] != current_user['id']:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Can only delete your own messages"
-        )
+    if not chat_id:
+        await _raise_message_not_editable(message_id, "delete")
     
-    if for_everyone:
-        # Delete for everyone
-        await update_message(message_id, {'deleted': True, 'content': 'This message was deleted'})
-        
-        # Broadcast deletion
-        await socket_manager.send_message_to_chat(message['chat_id'], {
-            'event': 'message_deleted',
-            'message_id': message_id
-        })
+    # Broadcast deletion
+    background_tasks.add_task(socket_manager.send_message_to_chat, chat_id, {
+        'event': 'message_deleted',
+        'message_id': message_id
+    })
     
     return {"message": "Message deleted"}
 
@@ -376,31 +320,21 @@ async def delete_message(
 async def add_reaction(
     message_id: str,
     reaction_data: ReactionCreate,
+    background_tasks: BackgroundTasks,
     current_user: dict = Depends(get_current_user)
 ):
     """Add reaction to a message"""
-    message = await get_message_by_id(message_id)
+    emoji = reaction_data.emoji
+    chat_id = await add_message_reaction(message_id, emoji, current_user['id'])
     
-    if not message:
+    if not chat_id:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Message not found"
         )
     
-    # Update reactions
-    reactions = message.get('reactions', {})
-    emoji = reaction_data.emoji
-    
-    if emoji not in reactions:
-        reactions[emoji] = []
-    
-    if current_user['id'] not in reactions[emoji]:
-        reactions[emoji].append(current_user['id'])
-    
-    await update_message(message_id, {'reactions': reactions})
-    
     # Broadcast reaction
-    await socket_manager.broadcast_reaction(message['chat_id'], {
+    background_tasks.add_task(socket_manager.broadcast_reaction, chat_id, {
         'message_id': message_id,
         'emoji': emoji,
         'user_id': current_user['id'],
@@ -413,30 +347,21 @@ async def add_reaction(
 async def remove_reaction(
     message_id: str,
     reaction_data: ReactionRemove,
+    background_tasks: BackgroundTasks,
     current_user: dict = Depends(get_current_user)
 ):
     """Remove reaction from a message"""
-    message = await get_message_by_id(message_id)
+    emoji = reaction_data.emoji
+    chat_id = await remove_message_reaction(message_id, emoji, current_user['id'])
     
-    if not message:
+    if not chat_id:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Message not found"
         )
     
-    # Update reactions
-    reactions = message.get('reactions', {})
-    emoji = reaction_data.emoji
-    
-    if emoji in reactions and current_user['id'] in reactions[emoji]:
-        reactions[emoji].remove(current_user['id'])
-        if not reactions[emoji]:
-            del reactions[emoji]
-    
-    await update_message(message_id, {'reactions': reactions})
-    
     # Broadcast reaction removal
-    await socket_manager.broadcast_reaction(message['chat_id'], {
+    background_tasks.add_task(socket_manager.broadcast_reaction, chat_id, {
         'message_id': message_id,
         'emoji': emoji,
         'user_id': current_user['id'],
@@ -445,32 +370,12 @@ async def remove_reaction(
     
     return {"message": "Reaction removed"}
 
-@router.post("/messages/{message_id}/read")
+@router.post("/messages/{message_id}/read", status_code=status.HTTP_202_ACCEPTED)
 async def mark_as_read(
     message_id: str,
     current_user: dict = Depends(get_current_user)
 ):
-    """Mark message as read"""
-    message = await get_message_by_id(message_id)
-    
-    if not message:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Message not found"
-        )
-    
-    # Update read status
-    read_by = message.get('read_by', [])
-    if current_user['id'] not in read_by:
-        read_by.append(current_user['id'])
-        await update_message(message_id, {'read_by': read_by, 'status': 'read'})
-        
-        # Broadcast read status
-        await socket_manager.update_message_status(
-            message['chat_id'],
-            message_id,
-            'read',
-            current_user['id']
-        )
+    """Mark message as read (written and broadcast in the next batch)"""
+    socket_manager.queue_read_receipt(current_user['id'], message_id)
     
     return {"message": "Marked as read"}
@@ -4,7 +4,10 @@ import logging
 
 from models import UserResponse
 from auth import get_current_user
-from database import Database, get_user_by_id, update_user
+from database import (
+    get_user_by_id, get_users_map, search_user_profiles, add_relationship, remove_relationship,
+    get_relationship_ids, RELATIONSHIP_CONTACT
+)
 
 router = APIRouter(prefix="/users", tags=["Users"])
 logger = logging.getLogger(__name__)
@@ -15,35 +18,23 @@ async def search_users(
     current_user: dict = Depends(get_current_user)
 ):
     """Search users by username, display name, or phone number"""
-    db = Database.get_db()
+    users = await search_user_profiles(q, current_user['id'])
     
-    # Search by username or display name
-    users = await db.users.find({
-        '$or': [
-            {'username': {'$regex': q, '$options': 'i'}},
-            {'display_name': {'$regex': q, '$options': 'i'}},
-            {'phone_number': {'$regex': q}}
-        ],
-        'id': {'$ne': current_user['id']}  # Exclude current user
-    }).limit(20).to_list(20)
+    return [UserResponse.from_user(user) for user in users]
+
+@router.get("/contacts", response_model=List[UserResponse])
+async def get_contacts(current_user: dict = Depends(get_current_user)):
+    """Get user's contacts"""
+    contacts = await get_relationship_ids(current_user['id'], RELATIONSHIP_CONTACT)
     
-    result = []
-    for user in users:
-        result.append(UserResponse(
-            id=user['id'],
-            username=user['username'],
-            display_name=user['display_name'],
-            avatar=user.get('avatar'),
-            bio=user.get('bio'),
-            phone_number=user.get('phone_number'),
-            email=user.get('email'),
-            role=user.get('role', 'regular'),
-            is_online=user.get('is_online', False),
-            last_seen=user.get('last_seen'),
-            created_at=user['created_at']
-        ))
+    # One cached/batched lookup for all contacts, kept in contact order
+    users_map = await get_users_map(contacts)
     
-    return result
+    return [
+        UserResponse.from_user(users_map[contact_id])
+        for contact_id in contacts
+        if contact_id in users_map
+    ]
 
 @router.get("/{user_id}", response_model=UserResponse)
 async def get_user(
@@ -59,19 +50,7 @@ async def get_user(
             detail="User not found"
         )
     
-    return UserResponse(
-        id=user['id'],
-        username=user['username'],
-        display_name=user['display_name'],
-        avatar=user.get('avatar'),
-        bio=user.get('bio'),
-        phone_number=user.get('phone_number'),
-        email=user.get('email'),
-        role=user.get('role', 'regular'),
-        is_online=user.get('is_online', False),
-        last_seen=user.get('last_seen'),
-        created_at=user['created_at']
-    )
+    return UserResponse.from_user(user)
 
 @router.post("/contacts/{user_id}")
 async def add_contact(
@@ -87,10 +66,7 @@ async def add_contact(
             detail="User not found"
         )
     
-    contacts = current_user.get('contacts', [])
-    if user_id not in contacts:
-        contacts.append(user_id)
-        await update_user(current_user['id'], {'contacts': contacts})
+    await add_relationship(current_user['id'], user_id, RELATIONSHIP_CONTACT)
     
     return {"message": "Contact added"}
 
@@ -100,34 +76,6 @@ async def remove_contact(
     current_user: dict = Depends(get_current_user)
 ):
     """Remove user from contacts"""
-    contacts = current_user.get('contacts', [])
-    if user_id in contacts:
-        contacts.remove(user_id)
-        await update_user(current_user['id'], {'contacts': contacts})
+    await remove_relationship(current_user['id'], user_id, RELATIONSHIP_CONTACT)
     
     return {"message": "Contact removed"}
-
-@router.get("/contacts", response_model=List[UserResponse])
-async def get_contacts(current_user: dict = Depends(get_current_user)):
-    """Get user's contacts"""
-    contacts = current_user.get('contacts', [])
-    
-    result = []
-    for contact_id in contacts:
-        user = await get_user_by_id(contact_id)
-        if user:
-            result.append(UserResponse(
-                id=user['id'],
-                username=user['username'],
-                display_name=user['display_name'],
-                avatar=user.get('avatar'),
-                bio=user.get('bio'),
-                phone_number=user.get('phone_number'),
-                email=user.get('email'),
-                role=user.get('role', 'regular'),
-                is_online=user.get('is_online', False),
-                last_seen=user.get('last_seen'),
-                created_at=user['created_at']
-            ))
-    
-    return result
@@ -1,6 +1,7 @@
 from fastapi import FastAPI, APIRouter, Request
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
@@ -26,6 +27,7 @@ limiter = Limiter(key_func=get_remote_address)
 # Import database and socket manager
 from database import Database
 from socket_manager import socket_manager
+from utils import APIJSONResponse
 
 # Import routes
 from routes_auth import router as auth_router
@@ -33,7 +35,8 @@ from routes_chat import router as chat_router
 from routes_users import router as users_router
 
 # Create the main app
-app = FastAPI(title="ChatApp API", version="1.0.0")
+# orjson serializes response bodies (incl. datetimes) in C
+app = FastAPI(title="ChatApp API", version="1.0.0", default_response_class=APIJSONResponse)
 
 # Add rate limiter state and exception handler
 app.state.limiter = limiter
@@ -71,6 +74,10 @@ app.add_middleware(
 # Add SlowAPI middleware for rate limiting
 app.add_middleware(SlowAPIMiddleware)
 
+# Compress JSON responses (chat/message lists). Socket.IO traffic is routed by
+# socket_app below before it reaches FastAPI, so it is never gzipped here.
+app.add_middleware(GZipMiddleware, minimum_size=500)
+
 # Mount Socket.IO
 socket_app = socketio.ASGIApp(
     socket_manager.sio,
@@ -84,11 +91,13 @@ async def startup_event():
     logger.info("Starting up ChatApp API...")
     await Database.create_indexes()
     logger.info("Database indexes created successfully")
+    socket_manager.start_read_flusher()
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Close database connection on shutdown"""
     logger.info("Shutting down ChatApp API...")
+    await socket_manager.stop_read_flusher()
     await Database.close_db()
     logger.info("Database connection closed")
 
@@ -1,17 +1,40 @@
 import socketio
+import asyncio
 import logging
-from typing import Dict, Set
-from datetime import datetime
-from utils import utc_now
+import orjson
+from typing import Dict, List, Optional, Set
+from database import (
+    update_user, get_user_by_id, get_relationship_ids, mark_messages_read,
+    RELATIONSHIP_CONTACT
+)
+from utils import utc_now, json_dumps
 
 logger = logging.getLogger(__name__)
 
+# Read receipts are buffered and written/broadcast in batches this often
+READ_FLUSH_INTERVAL_SECONDS = 0.1
+# A user's receipts are re-queued after a failed write, up to this many attempts
+READ_FLUSH_MAX_ATTEMPTS = 5
+
+class _OrjsonCodec:
+    """json-module stand-in for python-socketio, so emitted payloads (including
+    datetimes and enums straight from model_dump()) are encoded by orjson"""
+    
+    @staticmethod
+    def dumps(obj, *args, **kwargs) -> str:
+        return json_dumps(obj).decode()
+    
+    @staticmethod
+    def loads(data, *args, **kwargs):
+        return orjson.loads(data)
+
 class SocketManager:
     def __init__(self):
         # Create Socket.IO server with CORS settings
         self.sio = socketio.AsyncServer(
             async_mode='asgi',
             cors_allowed_origins='*',
+            json=_OrjsonCodec,
             logger=True,
             engineio_logger=True
         )
@@ -25,6 +48,12 @@ class SocketManager:
         # Track typing indicators: {chat_id: {user_id1, user_id2, ...}}
         self.typing_users: Dict[str, Set[str]] = {}
         
+        # Pending read receipts: {user_id: {message_id1, message_id2, ...}}
+        self._pending_reads: Dict[str, Set[str]] = {}
+        # Consecutive failed flushes per user: {user_id: attempts}
+        self._read_flush_failures: Dict[str, int] = {}
+        self._read_flusher: Optional[asyncio.Task] = None
+        
         self._register_handlers()
     
     def _register_handlers(self):
@@ -51,7 +80,6 @@ class SocketManager:
             if user_id:
                 # Update user status only if no other connections exist
                 if user_id not in self.user_connections:
-                    from database import update_user
                     await update_user(user_id, {
                         'is_online': False,
                         'last_seen': utc_now()
@@ -75,7 +103,6 @@ class SocketManager:
                 self.user_connections[user_id].add(sid)
                 
                 # Update user status
-                from database import update_user
                 await update_user(user_id, {'is_online': True, 'last_seen': utc_now()})
                 
                 logger.info(f"User {user_id} authenticated with session {sid}")
@@ -183,43 +210,92 @@ class SocketManager:
     async def send_message_to_user(self, user_id: str, event: str, data: dict):
         """Send a message to a specific user (all their connections)"""
         try:
-            if user_id in self.user_connections:
-                for sid in self.user_connections[user_id]:
-                    await self.sio.emit(event, data, room=sid)
+            sids = self.user_connections.get(user_id)
+            if sids:
+                await self.sio.emit(event, data, room=list(sids))
         except Exception as e:
             logger.error(f"Error sending message to user: {e}")
     
     async def broadcast_user_status(self, user_id: str, is_online: bool):
         """Broadcast user online/offline status to their contacts"""
         try:
-            from database import get_user_by_id
             user = await get_user_by_id(user_id)
             
             if not user:
                 return
             
-            # Send status to all contacts
-            contacts = user.get('contacts', [])
-            for contact_id in contacts:
-                await self.send_message_to_user(contact_id, 'user_status', {
+            # Send status to every connection of every online contact in one emit
+            contacts = await get_relationship_ids(user_id, RELATIONSHIP_CONTACT)
+            sids = [
+                sid
+                for contact_id in contacts
+                for sid in self.user_connections.get(contact_id, ())
+            ]
+            if sids:
+                await self.sio.emit('user_status', {
                     'user_id': user_id,
                     'is_online': is_online,
-                    'last_seen': user.get('last_seen').isoformat() if user.get('last_seen') else None
-                })
+                    'last_seen': user.get('last_seen')
+                }, room=sids)
         except Exception as e:
             logger.error(f"Error broadcasting user status: {e}")
     
-    async def update_message_status(self, chat_id: str, message_id: str, status: str, user_id: str):
-        """Broadcast message status update"""
+    async def update_message_status(self, chat_id: str, message_ids: List[str], status: str, user_id: str):
+        """Broadcast a status update for one or more messages"""
         try:
             await self.sio.emit('message_status', {
-                'message_id': message_id,
+                'message_ids': message_ids,
                 'status': status,
                 'user_id': user_id
             }, room=chat_id)
         except Exception as e:
             logger.error(f"Error updating message status: {e}")
     
+    def queue_read_receipt(self, user_id: str, message_id: str):
+        """Buffer a read receipt for the next flush"""
+        self._pending_reads.setdefault(user_id, set()).add(message_id)
+    
+    async def flush_read_receipts(self):
+        """Write buffered read receipts (one update per user) and broadcast them per chat"""
+        pending, self._pending_reads = self._pending_reads, {}
+        for user_id, message_ids in pending.items():
+            try:
+                by_chat = await mark_messages_read(list(message_ids), user_id)
+            except Exception as e:
+                # The client already got a 202, so keep the receipts for the next flush
+                attempts = self._read_flush_failures.get(user_id, 0) + 1
+                if attempts < READ_FLUSH_MAX_ATTEMPTS:
+                    self._read_flush_failures[user_id] = attempts
+                    self._pending_reads.setdefault(user_id, set()).update(message_ids)
+                    logger.warning(f"Error flushing read receipts for {user_id} (attempt {attempts}), will retry: {e}")
+                else:
+                    self._read_flush_failures.pop(user_id, None)
+                    logger.error(f"Dropping {len(message_ids)} read receipts for {user_id} after {attempts} failed flushes: {e}")
+                continue
+            
+            self._read_flush_failures.pop(user_id, None)
+            for chat_id, read_ids in by_chat.items():
+                await self.update_message_status(chat_id, read_ids, 'read', user_id)
+    
+    async def _run_read_flusher(self):
+        while True:
+            await asyncio.sleep(READ_FLUSH_INTERVAL_SECONDS)
+            await self.flush_read_receipts()
+    
+    def start_read_flusher(self):
+        if self._read_flusher is None:
+            self._read_flusher = asyncio.create_task(self._run_read_flusher())
+    
+    async def stop_read_flusher(self):
+        if self._read_flusher is not None:
+            self._read_flusher.cancel()
+            try:
+                await self._read_flusher
+            except asyncio.CancelledError:
+                pass
+            self._read_flusher = None
+        await self.flush_read_receipts()
+    
     async def broadcast_reaction(self, chat_id: str, reaction_data: dict):
         """Broadcast message reaction to chat"""
         try:
@@ -1,5 +1,8 @@
 """Utility functions for the chat application"""
 from datetime import datetime, timezone
+from typing import Any
+from fastapi.responses import ORJSONResponse
+import orjson
 
 def utc_now() -> datetime:
     """
@@ -7,3 +10,15 @@ def utc_now() -> datetime:
     Replaces deprecated datetime.utcnow()
     """
     return datetime.now(timezone.utc)
+
+def json_dumps(obj: Any) -> bytes:
+    """
+    Encode with orjson for HTTP bodies and Socket.IO payloads alike.
+    UTC datetimes end in "Z", matching Pydantic's JSON mode.
+    """
+    return orjson.dumps(obj, option=orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS)
+
+class APIJSONResponse(ORJSONResponse):
+    """Default response class: ORJSONResponse using json_dumps"""
+    def render(self, content: Any) -> bytes:
+        return json_dumps(content)
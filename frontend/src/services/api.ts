@@ -66,8 +66,9 @@ export const chatsAPI = {
   getChats: () => api.get('/chats'),
   getChat: (chatId: string) => api.get(`/chats/${chatId}`),
   createChat: (data: any) => api.post('/chats', data),
-  getMessages: (chatId: string, limit = 50, skip = 0) => 
-    api.get(`/chats/${chatId}/messages?limit=${limit}&skip=${skip}`),
+  // `before` / `beforeId` are the created_at and id of the oldest message already loaded
+  getMessages: (chatId: string, limit = 50, before?: string, beforeId?: string) => 
+    api.get(`/chats/${chatId}/messages`, { params: { limit, before, before_id: beforeId } }),
   sendMessage: (chatId: string, data: any) => api.post(`/chats/${chatId}/messages`, data),
   editMessage: (messageId: string, content: string) => 
     api.put(`/chats/messages/${messageId}`, { content }),